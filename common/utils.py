@@ -243,6 +243,15 @@ def _create_dct_filter(k1, k2, n):
     return f
 
 
+def get_dct_basis(n=8):
+    """
+    Returns the orthonormal 1D DCT-II basis as an (n x n) tensor `c`, where c[k, i] is the
+    weight of pixel i for frequency k. The 2D DCT of an (n x n) block is c @ block @ c.T,
+    so filter k1 * n + k2 of `create_conv_dct_filter` is the outer product of c[k1] and c[k2].
+    """
+    return torch.FloatTensor(fftpack.dct(np.eye(n), norm="ortho").T)
+
+
 def create_conv_dct_filter():
     """
     Create conv filters that work on a single channel image img. Make sure that:
@@ -295,6 +304,14 @@ if __name__ == "__main__":
                 correct_output = fftpack.dctn(block, norm="ortho")
                 assert np.allclose(conv_output.numpy(), correct_output, atol=1e-6)
 
+    # the separable form gives the same coefficients
+    basis = get_dct_basis(8)
+    blocks = x[:, 0].reshape(bs, blocks_h, 8, blocks_w, 8).permute(0, 1, 3, 2, 4)
+    separable = (basis @ blocks @ basis.T).reshape(bs, blocks_h, blocks_w, 64)
+    assert np.allclose(
+        separable.permute(0, 3, 1, 2).numpy(), dct_maps.detach().numpy(), atol=1e-5
+    )
+
     xhat = conv_idct(dct_maps)
 
     xhat = np.squeeze(xhat.numpy())
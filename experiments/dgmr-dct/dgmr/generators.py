@@ -1,7 +1,6 @@
-import einops
 import torch
 import torch.nn.functional as F
-from torch.nn.modules.pixelshuffle import PixelShuffle
+from torch.nn.utils import parametrize
 from torch.nn.utils.parametrizations import spectral_norm
 from typing import List
 from dgmr.common import GBlock, UpsampleGBlock
@@ -110,39 +109,8 @@ class Sampler(torch.nn.Module, PyTorchModelHubMixin):
             input_channels=output_channels // 4,  # latent_channels // 4,
             output_channels=output_channels // 4,  # latent_channels // 4
         )
-        # self.up_g3 = UpsampleGBlock(
-        #     input_channels=latent_channels // 4, output_channels=latent_channels // 8
-        # )
-
-        # self.convGRU4 = ConvGRU(
-        #     input_channels=latent_channels // 8 + context_channels // 8,
-        #     output_channels=context_channels // 8,
-        #     kernel_size=3,
-        # )
-        # self.gru_conv_1x1_4 = spectral_norm(
-        #     torch.nn.Conv2d(
-        #         in_channels=context_channels // 8,
-        #         out_channels=latent_channels // 8,
-        #         kernel_size=(1, 1),
-        #     )
-        # )
-        # self.g4 = GBlock(
-        #     input_channels=latent_channels // 8, output_channels=latent_channels // 8
-        # )
-        # self.up_g4 = UpsampleGBlock(
-        #     input_channels=latent_channels // 8, output_channels=latent_channels // 16
-        # )
-
-        # self.bn = torch.nn.BatchNorm2d(latent_channels // 16)
         self.bn = torch.nn.BatchNorm2d(output_channels // 4)
         self.relu = torch.nn.ReLU()
-        # self.conv_1x1 = spectral_norm(
-        #     torch.nn.Conv2d(
-        #         in_channels=latent_channels // 16,
-        #         out_channels=4 * output_channels,
-        #         kernel_size=(1, 1),
-        #     )
-        # )
         self.conv_1x1 = spectral_norm(
             torch.nn.Conv2d(
                 in_channels=output_channels // 4,
@@ -151,8 +119,6 @@ class Sampler(torch.nn.Module, PyTorchModelHubMixin):
             )
         )
 
-        # self.depth2space = PixelShuffle(upscale_factor=2)
-
     def forward(
         self, conditioning_states: List[torch.Tensor], latent_dim: torch.Tensor
     ) -> torch.Tensor:
@@ -169,49 +135,54 @@ class Sampler(torch.nn.Module, PyTorchModelHubMixin):
         # Iterate through each forecast step
         # Initialize with conditioning state for first one, output for second one
         init_states = conditioning_states
-        # Expand latent dim to match batch size
-        latent_dim = einops.repeat(
-            latent_dim, "b c h w -> (repeat b) c h w", repeat=init_states[0].shape[0]
-        )
+        # Expand latent dim to match batch size. The same latent is shared by the whole
+        # batch, so for the usual single latent sample this is a stride-0 view and the
+        # concat in the first ConvGRU is the only thing that reads it out.
+        repeat = init_states[0].shape[0]
+        latent_dim = latent_dim.unsqueeze(0).expand(repeat, *latent_dim.shape)
+        latent_dim = latent_dim.reshape(-1, *latent_dim.shape[2:])
         hidden_states = [latent_dim] * self.forecast_steps
 
         # TODO: can we make this into a UNET and remove the LSTM?
         # Layer 4 (bottom most)
         hidden_states = self.convGRU1(hidden_states, init_states[2])
-        hidden_states = [self.gru_conv_1x1(h) for h in hidden_states]
-        hidden_states = [self.g1(h) for h in hidden_states]
-        hidden_states = [self.up_g1(h) for h in hidden_states]
+        hidden_states = self._per_step(
+            hidden_states, self.gru_conv_1x1, self.g1, self.up_g1
+        )
 
         # Layer 3.
         hidden_states = self.convGRU2(hidden_states, init_states[1])
-        hidden_states = [self.gru_conv_1x1_2(h) for h in hidden_states]
-        hidden_states = [self.g2(h) for h in hidden_states]
-        hidden_states = [self.up_g2(h) for h in hidden_states]
+        hidden_states = self._per_step(
+            hidden_states, self.gru_conv_1x1_2, self.g2, self.up_g2
+        )
 
         # Layer 2.
         hidden_states = self.convGRU3(hidden_states, init_states[0])
-        hidden_states = [self.gru_conv_1x1_3(h) for h in hidden_states]
-        hidden_states = [self.g3(h) for h in hidden_states]
-        # hidden_states = [self.up_g3(h) for h in hidden_states]
-
-        hidden_states = [F.relu(self.bn(h)) for h in hidden_states]
-        hidden_states = [self.conv_1x1(h) for h in hidden_states]
-
-        # Layer 1 (top-most).
-        # hidden_states = self.convGRU4(hidden_states, init_states[0])
-        # hidden_states = [self.gru_conv_1x1_4(h) for h in hidden_states]
-        # hidden_states = [self.g4(h) for h in hidden_states]
-        # hidden_states = [self.up_g4(h) for h in hidden_states]
-
-        # # Output layer.
-        # hidden_states = [F.relu(self.bn(h)) for h in hidden_states]
-        # hidden_states = [self.conv_1x1(h) for h in hidden_states]
-        # hidden_states = [self.depth2space(h) for h in hidden_states]
-
-        # Convert forecasts to a torch Tensor
-        forecasts = torch.stack(hidden_states, dim=1)
+        hidden_states = self._per_step(
+            hidden_states,
+            self.gru_conv_1x1_3,
+            self.g3,
+            self.bn,
+            self.relu,
+            self.conv_1x1,
+        )
+
+        # Convert forecasts from [T, B, C, H, W] to [B, T, C, H, W]
+        forecasts = hidden_states.transpose(0, 1).contiguous()
         return forecasts
 
+    def _per_step(self, hidden_states: torch.Tensor, *layers) -> torch.Tensor:
+        # The ConvGRU outputs are [T, B, C, H, W] and every layer after it treats the
+        # timesteps independently, so fold time into the batch and run each layer once
+        # instead of once per timestep. In training mode the G block BatchNorms see T * B
+        # samples at once, and each spectral norm power iteration runs once per stage per
+        # forward rather than once per forecast step.
+        t, b = hidden_states.shape[:2]
+        x = hidden_states.reshape(t * b, *hidden_states.shape[2:])
+        for layer in layers:
+            x = layer(x)
+        return x.reshape(t, b, *x.shape[1:])
+
 
 class Generator(torch.nn.Module, PyTorchModelHubMixin):
     def __init__(
@@ -231,21 +202,95 @@ class Generator(torch.nn.Module, PyTorchModelHubMixin):
         self.conditioning_stack = conditioning_stack
         self.latent_stack = latent_stack
         self.sampler = sampler
-        self.conv_dct = utils.create_conv_dct_filter()
-        self.conv_idct = utils.get_idct_filter()
+        # The DCT and IDCT are fixed linear maps. Keeping them as non-persistent buffers
+        # means they follow .to()/.half() with the model and are not handed to the
+        # optimizer as frozen parameters.
+        # The 8x8 DCT is separable, c @ block @ c.T, so it runs as a stride 8 conv down the
+        # rows (8 row frequencies) then a grouped stride 8 conv along the columns (8 column
+        # frequencies per row frequency): 2 * 8 instead of 64 MACs per coefficient. The
+        # IDCT is the transpose, the same two weights used as transposed convs in reverse.
+        basis = utils.get_dct_basis(8)
+        self.register_buffer(
+            "dct_rows", basis.reshape(8, 1, 8, 1).contiguous(), persistent=False
+        )
+        self.register_buffer(
+            "dct_cols", basis.repeat(8, 1).reshape(64, 1, 1, 8), persistent=False
+        )
+        self.idct_fused = False
 
     def forward(self, x):
-        b, t, c, h, w = x.shape
-        x = x.reshape(b * t, c, h, w)
-        x = self.conv_dct(x)
-        x = x.reshape(b, t, x.shape[1], x.shape[2], x.shape[3])
+        # The DCT/IDCT are per image, run them on (batch * time) views
+        b, t = x.shape[:2]
+        x = x.flatten(0, 1)
+        x = F.conv2d(x, self.dct_rows, stride=(8, 1))
+        x = F.conv2d(x, self.dct_cols, stride=(1, 8), groups=8)
+        x = x.view(b, t, *x.shape[1:])
         conditioning_states = self.conditioning_stack(x)
         latent_dim = self.latent_stack(x)
         x = self.sampler(conditioning_states, latent_dim)
-        b, t, c, h, w = x.shape
-        x = x.reshape(b * t, c, h, w)
-        x = self.conv_idct(x)
-        x = x.reshape(b, t, x.shape[1], x.shape[2])
-        # add a channel saying this is a 1-D image
-        x = torch.unsqueeze(x, dim=2)
+        b, t = x.shape[:2]
+        x = x.flatten(0, 1)
+        if self.idct_fused:
+            x = F.pixel_shuffle(x, 8)
+        else:
+            x = F.conv_transpose2d(x, self.dct_cols, stride=(1, 8), groups=8)
+            x = F.conv_transpose2d(x, self.dct_rows, stride=(8, 1))
+        # keeps the channel saying this is a 1-D image
+        x = x.view(b, t, *x.shape[1:])
         return x
+
+    def fuse_idct(self):
+        """
+        Folds the IDCT 1x1 conv into the sampler's last 1x1 conv, for inference only.
+        Both are linear maps over the 64 DCT channels, so W' = IDCT @ W and b' = IDCT @ b,
+        and what is left of the IDCT is a depth-to-space of the 8x8 blocks.
+        This bakes in the current spectral norm of that conv, so call after `.eval()`.
+        """
+        if self.training:
+            raise RuntimeError(
+                "fuse_idct() freezes the sampler's conv_1x1, call .eval() first"
+            )
+        if self.idct_fused:
+            return self
+        conv = self.sampler.conv_1x1
+        if parametrize.is_parametrized(conv, "weight"):
+            parametrize.remove_parametrizations(conv, "weight", leave_parametrized=True)
+        # pixel i * 8 + j of a block from coefficient k1 * 8 + k2 is c[k1, i] * c[k2, j]
+        basis = self.dct_rows.reshape(8, 8)
+        idct = torch.kron(basis.t(), basis.t())
+        with torch.no_grad():
+            conv.weight.copy_((idct @ conv.weight.flatten(1)).view_as(conv.weight))
+            conv.bias.copy_(idct @ conv.bias)
+        self.idct_fused = True
+        return self
+
+    def upgrade_optimizer_state(self, state_dict: dict) -> dict:
+        """
+        Optimizer states saved while the DCT was a frozen conv module still list its
+        weight and bias as the last two params of the (single) param group. They never
+        had gradients, so have no Adam state, and can just be dropped.
+        Args:
+            state_dict: `optimizer.state_dict()` of an optimizer over `model.parameters()`
+
+        Returns:
+            A state dict that matches the current `model.parameters()`
+        """
+        group = state_dict["param_groups"][0]
+        if len(group["params"]) != len(list(self.parameters())) + 2:
+            return state_dict
+        state_dict = dict(state_dict)
+        dropped = group["params"][-2:]
+        state_dict["param_groups"] = [
+            dict(group, params=group["params"][:-2]),
+            *state_dict["param_groups"][1:],
+        ]
+        state_dict["state"] = {
+            k: v for k, v in state_dict["state"].items() if k not in dropped
+        }
+        return state_dict
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older checkpoints stored the DCT as a frozen conv module
+        for key in ("conv_dct.weight", "conv_dct.bias"):
+            state_dict.pop(prefix + key, None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
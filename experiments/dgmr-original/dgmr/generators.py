@@ -1,9 +1,10 @@
-import einops
 import torch
 import torch.nn.functional as F
+from torch import quantization
 from torch.nn.modules.pixelshuffle import PixelShuffle
+from torch.nn.utils import parametrize
 from torch.nn.utils.parametrizations import spectral_norm
-from typing import List
+from typing import Iterable, List, Optional, Tuple
 from dgmr.common import GBlock, UpsampleGBlock
 from dgmr.layers import ConvGRU
 from huggingface_hub import PyTorchModelHubMixin
@@ -13,6 +14,31 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.WARN)
 
 
+def conv_1x1_depth2space(
+    x: torch.Tensor, weight: torch.Tensor, bias: torch.Tensor, upscale_factor: int
+) -> torch.Tensor:
+    """
+    Same as `pixel_shuffle(conv2d(x, weight, bias), upscale_factor)` for a 1x1 conv, but
+    writes the output in its shuffled layout directly instead of materializing the
+    (r*r*C)xHxW conv output and then permuting it.
+
+    out[n, c, r*y+i, r*x+j] = sum_k weight[c*r*r + i*r + j, k] * x[n, k, y, x], which is a
+    transposed conv with kernel size == stride == r, so the windows never overlap.
+    """
+    r = upscale_factor
+    in_channels = weight.shape[1]
+    out_channels = weight.shape[0] // (r * r)
+    weight = weight.reshape(out_channels, r, r, in_channels).permute(3, 0, 1, 2)
+    out = F.conv_transpose2d(x, weight, stride=r)
+    if bias is not None:
+        # The bias differs per position inside each rxr window, add it on a window view
+        b, _, h, w = x.shape
+        out = out.reshape(b, out_channels, h, r, w, r)
+        out = out.add_(bias.view(1, out_channels, 1, r, 1, r))
+        out = out.reshape(b, out_channels, h * r, w * r)
+    return out
+
+
 class Sampler(torch.nn.Module, PyTorchModelHubMixin):
     def __init__(
         self,
@@ -129,6 +155,9 @@ class Sampler(torch.nn.Module, PyTorchModelHubMixin):
 
         self.depth2space = PixelShuffle(upscale_factor=2)
 
+        # NHWC convolutions map directly onto tensor cores
+        self.to(memory_format=torch.channels_last)
+
     def forward(
         self, conditioning_states: List[torch.Tensor], latent_dim: torch.Tensor
     ) -> torch.Tensor:
@@ -144,46 +173,186 @@ class Sampler(torch.nn.Module, PyTorchModelHubMixin):
         """
         # Iterate through each forecast step
         # Initialize with conditioning state for first one, output for second one
-        init_states = conditioning_states
-        # Expand latent dim to match batch size
-        latent_dim = einops.repeat(
-            latent_dim, "b c h w -> (repeat b) c h w", repeat=init_states[0].shape[0]
-        )
-        hidden_states = [latent_dim] * self.forecast_steps
+        # Move everything to channels last once here, the layers below preserve it
+        init_states = [
+            s.contiguous(memory_format=torch.channels_last) for s in conditioning_states
+        ]
+        # Expand latent dim to match batch size. This has to be materialized: a stride-0
+        # view over the batch makes the concat in the first ConvGRU come out NCHW, and
+        # its gate convs would then convert layouts at every timestep. Copying the small
+        # bottom-resolution latent once is much cheaper.
+        repeat = init_states[0].shape[0]
+        latent_dim = latent_dim.unsqueeze(0).expand(repeat, *latent_dim.shape)
+        latent_dim = latent_dim.reshape(-1, *latent_dim.shape[2:])
+        latent_dim = latent_dim.contiguous(memory_format=torch.channels_last)
 
         # Layer 4 (bottom most)
-        hidden_states = self.convGRU1(hidden_states, init_states[3])
-        hidden_states = [self.gru_conv_1x1(h) for h in hidden_states]
-        hidden_states = [self.g1(h) for h in hidden_states]
-        hidden_states = [self.up_g1(h) for h in hidden_states]
+        # Every forecast step sees the same latent
+        hidden_states = self.convGRU1(
+            latent_dim, init_states[3], steps=self.forecast_steps
+        )
+        hidden_states = self._per_step(
+            hidden_states, self.gru_conv_1x1, self.g1, self.up_g1
+        )
 
         # Layer 3.
         hidden_states = self.convGRU2(hidden_states, init_states[2])
-        hidden_states = [self.gru_conv_1x1_2(h) for h in hidden_states]
-        hidden_states = [self.g2(h) for h in hidden_states]
-        hidden_states = [self.up_g2(h) for h in hidden_states]
+        hidden_states = self._per_step(
+            hidden_states, self.gru_conv_1x1_2, self.g2, self.up_g2
+        )
 
         # Layer 2.
         hidden_states = self.convGRU3(hidden_states, init_states[1])
-        hidden_states = [self.gru_conv_1x1_3(h) for h in hidden_states]
-        hidden_states = [self.g3(h) for h in hidden_states]
-        hidden_states = [self.up_g3(h) for h in hidden_states]
+        hidden_states = self._per_step(
+            hidden_states, self.gru_conv_1x1_3, self.g3, self.up_g3
+        )
 
         # Layer 1 (top-most).
-        hidden_states = self.convGRU4(hidden_states, init_states[0])
-        hidden_states = [self.gru_conv_1x1_4(h) for h in hidden_states]
-        hidden_states = [self.g4(h) for h in hidden_states]
-        hidden_states = [self.up_g4(h) for h in hidden_states]
+        # From here on the layers don't care about the order of the folded batch, so
+        # have the ConvGRU write [B, T, C, H, W] and the forecasts need no transpose
+        hidden_states = self.convGRU4(
+            hidden_states, init_states[0], batch_first_output=True
+        )
+        hidden_states = self._per_step(
+            hidden_states, self.gru_conv_1x1_4, self.g4, self.up_g4
+        )
 
         # Output layer.
-        hidden_states = [F.relu(self.bn(h)) for h in hidden_states]
-        hidden_states = [self.conv_1x1(h) for h in hidden_states]
-        hidden_states = [self.depth2space(h) for h in hidden_states]
+        hidden_states = self._per_step(
+            hidden_states, self.bn, self.relu, self._conv_1x1_depth2space
+        )
 
-        # Convert forecasts to a torch Tensor
-        forecasts = torch.stack(hidden_states, dim=1)
+        # Already [B, T, C, H, W]
+        forecasts = hidden_states
         return forecasts
 
+    def compile_blocks(self, mode: str = "max-autotune"):
+        """
+        Compiles the batched per stage chains (1x1 conv -> GBlock -> UpsampleGBlock, and the
+        output layer) with torch.compile so Inductor can fuse the BN/ReLU/residual adds
+        between the convs. Unlike `Generator.compile_stacks` the ConvGRU loops stay eager,
+        which keeps compile times short. The modules stay registered where they are, so the
+        state dict is unchanged.
+        Args:
+            mode: torch.compile mode
+        """
+        if not hasattr(torch, "compile"):
+            raise RuntimeError("torch.compile requires PyTorch 2.0 or newer")
+        # One graph per stage, each guarded on the layers it was called with
+        self._per_step = torch.compile(self._per_step, mode=mode)
+        return self
+
+    def quantize_1x1_convs(
+        self,
+        calibration_data: Iterable[Tuple[List[torch.Tensor], torch.Tensor]],
+    ):
+        """
+        Post-training static int8 quantization of the `gru_conv_1x1*` convs, for CPU
+        inference. These pointwise convs have stable per channel weight statistics, the
+        G blocks / BN stay in float. The final `conv_1x1` is left in float too, since it
+        runs fused with the depth2space.
+        Args:
+            calibration_data: (conditioning_states, latent_dim) sampler inputs used to
+                calibrate the activation observers, e.g. from a few validation batches
+        """
+        if next(self.parameters()).device.type != "cpu":
+            raise RuntimeError("PyTorch's int8 conv kernels only run on the CPU")
+        # Quantization needs plain Conv2d weights, not spectral norm parametrizations
+        self.prepare_for_inference()
+        qconfig = quantization.get_default_qconfig(torch.backends.quantized.engine)
+        for name in (
+            "gru_conv_1x1",
+            "gru_conv_1x1_2",
+            "gru_conv_1x1_3",
+            "gru_conv_1x1_4",
+        ):
+            # Quantize the input and dequantize the output around each conv
+            wrapped = quantization.QuantWrapper(getattr(self, name))
+            wrapped.qconfig = qconfig
+            setattr(self, name, wrapped)
+        quantization.prepare(self, inplace=True)
+        with torch.no_grad():
+            for conditioning_states, latent_dim in calibration_data:
+                self(conditioning_states, latent_dim)
+        quantization.convert(self, inplace=True)
+        return self
+
+    def prepare_for_inference(self):
+        """
+        Bakes every spectral norm in the sampler into its conv weight, then folds the output
+        BN (see `eval_fuse`). In eval mode sigma no longer changes, but the parametrization
+        still recomputes W / sigma on every weight access, which for the ConvGRUs is every
+        timestep. Call after `.eval()`, the sampler should not be trained afterwards.
+        """
+        if self.training:
+            raise RuntimeError(
+                "prepare_for_inference() freezes the weights, call .eval() first"
+            )
+        for module in list(self.modules()):
+            if parametrize.is_parametrized(module, "weight"):
+                parametrize.remove_parametrizations(
+                    module, "weight", leave_parametrized=True
+                )
+        return self.eval_fuse()
+
+    def eval_fuse(self):
+        """
+        Folds the output BatchNorm into the two convs that sum to the `up_g4` output, for
+        inference. In eval mode BN is the per channel affine s * x + t with
+        s = gamma / sqrt(var + eps) and t = beta - mean * s, and since
+        s * (conv_3x3(x) + conv_1x1(x)) + t only needs t added once, it goes in the 3x3 bias.
+        Call after `.eval()` and before any compile / CUDA graph capture.
+        """
+        if self.training:
+            raise RuntimeError(
+                "eval_fuse() uses the BN running stats, call .eval() first"
+            )
+        if isinstance(self.bn, torch.nn.Identity):
+            return self
+        bn = self.bn
+        with torch.no_grad():
+            scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+            shift = bn.bias - bn.running_mean * scale
+            for conv in (self.up_g4.last_conv_3x3, self.up_g4.conv_1x1):
+                # Bake the current spectral norm into the weight so it can be rescaled
+                if parametrize.is_parametrized(conv, "weight"):
+                    parametrize.remove_parametrizations(
+                        conv, "weight", leave_parametrized=True
+                    )
+                conv.weight.mul_(scale.view(-1, 1, 1, 1))
+                conv.bias.mul_(scale)
+            self.up_g4.last_conv_3x3.bias.add_(shift)
+        self.bn = torch.nn.Identity()
+        # Nothing else reads the up_g4 output, so the ReLU can overwrite it
+        self.relu = torch.nn.ReLU(inplace=True)
+        return self
+
+    def _conv_1x1_depth2space(self, x: torch.Tensor) -> torch.Tensor:
+        return conv_1x1_depth2space(
+            x,
+            self.conv_1x1.weight,
+            self.conv_1x1.bias,
+            self.depth2space.upscale_factor,
+        )
+
+    def _per_step(self, hidden_states: torch.Tensor, *layers) -> torch.Tensor:
+        # The ConvGRU outputs are [T, B, C, H, W] (or [B, T, ...]) and every layer after
+        # it treats the timesteps independently, so fold time into the batch and run each
+        # layer once instead of once per timestep. One T * B sized kernel fills the GPU
+        # better than spreading T small ones over side streams would, and needs no
+        # cross-stream synchronization or record_stream bookkeeping.
+        # In training mode this changes two things: the G block BatchNorms see statistics
+        # over all T * B samples of a stage instead of B per step, and the spectral norm
+        # power iteration of each conv now runs once per stage per forward instead of
+        # once per forecast step, so u / v converge T times slower.
+        t, b = hidden_states.shape[:2]
+        x = hidden_states.reshape(t * b, *hidden_states.shape[2:])
+        # No-op when the ConvGRU already wrote NHWC timesteps
+        x = x.contiguous(memory_format=torch.channels_last)
+        for layer in layers:
+            x = layer(x)
+        return x.reshape(t, b, *x.shape[1:])
+
 
 class Generator(torch.nn.Module, PyTorchModelHubMixin):
     def __init__(
@@ -191,6 +360,8 @@ class Generator(torch.nn.Module, PyTorchModelHubMixin):
         conditioning_stack: torch.nn.Module,
         latent_stack: torch.nn.Module,
         sampler: torch.nn.Module,
+        use_cuda_graph: bool = False,
+        autocast_dtype: Optional[torch.dtype] = None,
     ):
         """
         Wraps the three parts of the generator for simpler calling
@@ -198,14 +369,112 @@ class Generator(torch.nn.Module, PyTorchModelHubMixin):
             conditioning_stack:
             latent_stack:
             sampler:
+            use_cuda_graph: Whether to replay the sampler from a captured CUDA graph during
+                inference (eval mode, no grad, CUDA inputs)
+            autocast_dtype: If set, e.g. torch.bfloat16, run the forward under torch.autocast
+                with this dtype. The output is cast back to the input dtype
         """
         super().__init__()
         self.conditioning_stack = conditioning_stack
         self.latent_stack = latent_stack
         self.sampler = sampler
+        self.use_cuda_graph = use_cuda_graph
+        self.autocast_dtype = autocast_dtype
+        self._graph = None
+        self._static_inputs = None
+        self._static_output = None
+        self._graph_weights = None
 
     def forward(self, x):
+        if self.autocast_dtype is None:
+            return self._forward(x)
+        # The autocast weight cache would hold tensors from outside a graph capture
+        with torch.autocast(
+            device_type=x.device.type,
+            dtype=self.autocast_dtype,
+            cache_enabled=not self.use_cuda_graph,
+        ):
+            out = self._forward(x)
+        return out.to(x.dtype)
+
+    def _forward(self, x):
         conditioning_states = self.conditioning_stack(x)
         latent_dim = self.latent_stack(x)
+        if (
+            self.use_cuda_graph
+            and x.is_cuda
+            and not self.training
+            and not torch.is_grad_enabled()
+        ):
+            return self._graphed_sampler(conditioning_states, latent_dim)
         x = self.sampler(conditioning_states, latent_dim)
         return x
+
+    def compile_stacks(self, mode: str = "max-autotune"):
+        """
+        Compiles the forward of the conditioning stacks and the sampler with torch.compile,
+        which fuses the elementwise BN/ReLU/residual chains into the surrounding kernels
+        Args:
+            mode: torch.compile mode, "max-autotune" and "reduce-overhead" also capture CUDA graphs
+        """
+        if not hasattr(torch, "compile"):
+            raise RuntimeError("torch.compile requires PyTorch 2.0 or newer")
+        # Each new batch size / forecast length is a recompile, don't fall back to eager
+        torch._dynamo.config.cache_size_limit = 64
+        # Compile forward in place so the state dict keys are unchanged
+        for module in (self.conditioning_stack, self.latent_stack, self.sampler):
+            module.forward = torch.compile(module.forward, mode=mode)
+        # Inductor already manages CUDA graphs for the compiled sampler
+        self.use_cuda_graph = False
+        return self
+
+    def _graphed_sampler(
+        self, conditioning_states: List[torch.Tensor], latent_dim: torch.Tensor
+    ) -> torch.Tensor:
+        # The sampler launches hundreds of small kernels with the same shapes on every
+        # call, so it is recorded once and replayed with a single launch afterwards.
+        inputs = [*conditioning_states, latent_dim]
+        # The graph reads the weights from the storages they had at capture time, and
+        # prepare_for_inference / eval_fuse / quantize_1x1_convs swap in new ones (or
+        # replace whole modules), so recapture when they change like for a new shape
+        if (
+            self._graph is None
+            or self._graph_weights != self._sampler_weights()
+            or any(
+                static.shape != new.shape or static.dtype != new.dtype
+                for static, new in zip(self._static_inputs, inputs)
+            )
+        ):
+            self._capture_sampler(inputs)
+        for static, new in zip(self._static_inputs, inputs):
+            static.copy_(new)
+        self._graph.replay()
+        # The output lives in the graph's memory pool and is overwritten on every replay
+        return self._static_output.clone()
+
+    def _sampler_weights(self) -> Tuple[List[int], List[int]]:
+        # Replaced modules (BN -> Identity, removed parametrizations, quantized convs)
+        # and re-allocated weights both show up here, in place updates don't need to
+        modules = [id(m) for m in self.sampler.modules()]
+        tensors = [*self.sampler.parameters(), *self.sampler.buffers()]
+        return modules, [t.data_ptr() for t in tensors]
+
+    def _capture_sampler(self, inputs: List[torch.Tensor]):
+        self._graph_weights = self._sampler_weights()
+        self._static_inputs = [i.clone() for i in inputs]
+        conditioning_states, latent_dim = (
+            self._static_inputs[:-1],
+            self._static_inputs[-1],
+        )
+
+        # Warm up on a side stream so cuDNN autotuning is not recorded into the graph
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self.sampler(conditioning_states, latent_dim)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self._graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self._graph):
+            self._static_output = self.sampler(conditioning_states, latent_dim)
@@ -1,3 +1,5 @@
+from typing import Optional
+
 import torch
 import torch.nn.functional as F
 from torch.nn.utils.parametrizations import spectral_norm
@@ -87,13 +89,76 @@ class ConvGRU(torch.nn.Module):
     ):
         super().__init__()
         self.cell = ConvGRUCell(input_channels, output_channels, kernel_size, sn_eps)
+        # Outputs are written into the same memory on every no-grad call with the same
+        # shapes, which keeps addresses stable for CUDA graph capture/replay
+        self._h_buf: Optional[torch.Tensor] = None
+        self._h_buf_key = None
+
+    def forward(
+        self,
+        x: torch.Tensor,
+        hidden_state=None,
+        steps: Optional[int] = None,
+        batch_first_output: bool = False,
+    ) -> torch.Tensor:
+        """
+        Args:
+            x: [T, B, C, H, W] inputs, one per timestep, or a single [B, C, H, W] input
+                that is fed at each of `steps` timesteps
+            hidden_state: Initial [B, C, H, W] state
+            steps: Number of timesteps, only needed when `x` is a single input
+            batch_first_output: Write the outputs as [B, T, C, H, W] instead, so callers that
+                fold time into the batch can get a [B * T, ...] view without a transpose copy
 
-    def forward(self, x: torch.Tensor, hidden_state=None) -> torch.Tensor:
-        outputs = []
+        Returns:
+            [T, B, C, H, W] outputs, or [B, T, C, H, W] with `batch_first_output`. With
+            grad disabled these are overwritten by the next call with the same shapes.
+        """
+        if x.dim() == 4:
+            if steps is None:
+                raise ValueError("steps is required when x is a single timestep")
+            # Stride-0 view, every step reads the same input
+            x = x.unsqueeze(0).expand(steps, *x.shape)
+        # Write every timestep straight into one output tensor instead of stacking a list
+        # of outputs at the end
+        outputs = self._outputs(len(x), hidden_state, batch_first_output)
+        steps_view = outputs.transpose(0, 1) if batch_first_output else outputs
         for step in range(len(x)):
             # Compute current timestep
             output, hidden_state = self.cell(x[step], hidden_state)
-            outputs.append(output)
-        # Stack outputs to return as tensor
-        outputs = torch.stack(outputs, dim=0)
+            steps_view[step] = output
         return outputs
+
+    def _outputs(
+        self, steps: int, like: torch.Tensor, batch_first: bool
+    ) -> torch.Tensor:
+        if torch.is_grad_enabled():
+            # Autograd may still need the outputs of an earlier call
+            return _empty_steps(steps, like, batch_first)
+        key = (
+            steps,
+            like.shape,
+            like.dtype,
+            like.device,
+            like.is_contiguous(memory_format=torch.channels_last),
+            batch_first,
+            torch.is_inference_mode_enabled(),
+        )
+        if self._h_buf is None or self._h_buf_key != key:
+            self._h_buf = _empty_steps(steps, like, batch_first)
+            self._h_buf_key = key
+        return self._h_buf
+
+
+def _empty_steps(
+    steps: int, like: torch.Tensor, batch_first: bool = False
+) -> torch.Tensor:
+    """
+    Allocates a [steps, B, C, H, W] (or [B, steps, C, H, W] if `batch_first`) tensor whose
+    timesteps keep the memory format of `like`
+    """
+    b, c, h, w = like.shape
+    leading = (b, steps) if batch_first else (steps, b)
+    if like.is_contiguous(memory_format=torch.channels_last):
+        return like.new_empty((*leading, h, w, c)).permute(0, 1, 4, 2, 3)
+    return like.new_empty((*leading, c, h, w))